@@ -1,26 +1,34 @@
 # check_prices.py
 """
 Price tracker optimized for Apify:
-- Uses Apify proxy only for Croma (APIFY_PROXY_* env vars).
-- Uses default no-proxy browser for other sites.
+- Uses Apify proxy only for Croma (APIFY_PROXY_* env vars), set per context.
+- One set of browsers serves every site; other sites get no-proxy contexts.
 - Stealth init script applied for Croma contexts.
-- Saves failing HTML to debug_failures/ on extraction failure.
+- Saves failing HTML to debug_failures/ on extraction failure (when DEBUG_DUMPS is set).
 Environment vars expected:
   SUPABASE_URL, SUPABASE_KEY, SLACK_WEBHOOK (optional)
+  DEBUG_DUMPS (optional)           -> "1" to write failing pages to debug_failures/
+  MAX_CONCURRENCY (optional)       -> pages scraped in parallel, default: 6
+  RECHECK_AFTER_MINUTES (optional) -> skip items checked more recently, default: 10
   APIFY_PROXY_PASSWORD (optional)  -> Apify Proxy password (find in Apify Console -> Proxy)
   APIFY_PROXY_HOSTNAME (optional)  -> default: proxy.apify.com
   APIFY_PROXY_PORT (optional)      -> default: 8000
   APIFY_PROXY_GROUPS (optional)    -> e.g. RESIDENTIAL
 """
 import asyncio
+import contextlib
+import functools
+import json
 import os
 import re
 import random
 import traceback
 import pathlib
-from datetime import datetime, timezone
-import requests
-from bs4 import BeautifulSoup
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from html import unescape
+import httpx
+from selectolax.lexbor import LexborHTMLParser
 from supabase import create_client
 from dotenv import load_dotenv
 from playwright.async_api import async_playwright, Error as PlaywrightError
@@ -39,31 +47,224 @@ APIFY_PROXY_HOSTNAME = os.getenv("APIFY_PROXY_HOSTNAME", "proxy.apify.com")
 APIFY_PROXY_PORT = os.getenv("APIFY_PROXY_PORT", "8000")
 APIFY_PROXY_GROUPS = os.getenv("APIFY_PROXY_GROUPS", "").strip()  # e.g. RESIDENTIAL
 
+# max number of pages open at the same time across the browser pool (at least 1)
+try:
+    MAX_PARALLEL_PAGES = int(os.getenv("MAX_CONCURRENCY", "6"))
+except ValueError:
+    print(f"[WARN] MAX_CONCURRENCY={os.getenv('MAX_CONCURRENCY')!r} is not an integer, using 6")
+    MAX_PARALLEL_PAGES = 6
+if MAX_PARALLEL_PAGES < 1:
+    print(f"[WARN] MAX_CONCURRENCY={MAX_PARALLEL_PAGES} would never run a page, using 1")
+    MAX_PARALLEL_PAGES = 1
+# chromium instances in the browser pool
+BROWSER_POOL_SIZE = 3
+
+# items checked more recently than this are skipped (0 rechecks everything)
+try:
+    RECHECK_AFTER_MINUTES = int(os.getenv("RECHECK_AFTER_MINUTES", "10"))
+except ValueError:
+    print(f"[WARN] RECHECK_AFTER_MINUTES={os.getenv('RECHECK_AFTER_MINUTES')!r} is not an integer, using 10")
+    RECHECK_AFTER_MINUTES = 10
+if RECHECK_AFTER_MINUTES < 0:
+    print(f"[WARN] RECHECK_AFTER_MINUTES={RECHECK_AFTER_MINUTES} is negative, using 0")
+    RECHECK_AFTER_MINUTES = 0
+
+# NOT NULL tracked_items columns carried in each upsert row, since Postgres checks
+# them on the insert arm before the ON CONFLICT update. PostgREST updates every
+# column it is sent, so these are written back as read at the start of the run.
+TRACKED_REQUIRED_COLUMNS = ("site", "product_url")
+
+# reused contexts are swapped for a fresh one after this many pages
+MAX_PAGES_PER_CONTEXT = 25
+
+# resource types never needed for price extraction
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+# analytics / ad hosts whose requests are aborted whatever their type
+ANALYTICS_DOMAINS = (
+    "google-analytics.com",
+    "doubleclick.net",
+    "facebook.net",
+    "facebook.com/tr",
+    "hotjar.com",
+    "segment.com",
+    "segment.io",
+)
+
+# price element per site; the page is read as soon as it becomes visible
+SITE_PRICE_SELECTOR = {
+    "flipkart": ".Nx9bqj.CxhGGd",
+    "amazon": "span.a-price-whole",
+    "reliance": "div.product-price",
+}
+# Croma can also be read from its state blob, so it waits on either
+CROMA_READY_JS = """() => {
+    const nd = document.getElementById('__NEXT_DATA__');
+    return !!((nd && nd.textContent.includes('sellingPrice'))
+        || document.querySelector('#pdp-product-price, div.product-price, span.pdp-selling-price'));
+}"""
+
+# JS returning the price element's text straight from the page (None if absent)
+PRICE_EVAL_JS = {
+    "flipkart": "() => document.querySelector('.Nx9bqj.CxhGGd')?.textContent ?? null",
+    "amazon": """() => {
+        const whole = document.querySelector('span.a-price-whole');
+        if (!whole) return null;
+        const digits = whole.textContent.replace(/\\D/g, '');
+        // an empty/template span must fall back to the HTML, not read as ".00"
+        if (!digits) return null;
+        const frac = document.querySelector('span.a-price-fraction');
+        return digits + '.' + (frac ? frac.textContent.replace(/\\D/g, '') : '00');
+    }""",
+    "reliance": "() => document.querySelector('div.product-price')?.textContent ?? null",
+}
+
+# Croma in one round-trip: {price, title, mrp} from the JS state, or null (then
+# the full HTML is pulled and goes through JSON-LD, regexes and DOM selectors)
+CROMA_EXTRACT_JS = """() => {
+    // a missing or zero (placeholder) value is no price
+    const hasValue = (sp) => !!sp && Number(String(sp.value).replace(/[^\\d.]/g, '')) > 0;
+    const pack = (o, sp) => ({
+        price: String(sp.value),
+        title: (o && (o.name || o.title)) || document.title || null,
+        mrp: o && hasValue(o.mrp) ? String(o.mrp.value) : null,
+    });
+    // __NEXT_DATA__ is plain JSON in a script tag: parse it and walk it once
+    const nd = document.getElementById('__NEXT_DATA__');
+    if (nd) {
+        try {
+            const walk = (o) => {
+                if (!o || typeof o !== 'object') return null;
+                if (hasValue(o.sellingPrice)) return pack(o, o.sellingPrice);
+                for (const k in o) { const r = walk(o[k]); if (r) return r; }
+                return null;
+            };
+            const r = walk(JSON.parse(nd.textContent));
+            if (r) return r;
+        } catch (e) {}
+    }
+    // then a few known state globals, read directly
+    try {
+        const st = window.__INITIAL_STATE__;
+        const candidates = [st && st.product, st && st.pdpPriceData, window.pdpPriceData];
+        for (const o of candidates) {
+            if (o && hasValue(o.sellingPrice)) return pack(o, o.sellingPrice);
+        }
+    } catch (e) {}
+    return null;
+}"""
+
+DEBUG_DUMPS = os.getenv("DEBUG_DUMPS", "").lower() in ("1", "true", "yes")
 DEBUG_DIR = pathlib.Path("debug_failures")
-DEBUG_DIR.mkdir(exist_ok=True)
+if DEBUG_DUMPS:
+    DEBUG_DIR.mkdir(exist_ok=True)
+
+# Croma price patterns, most specific first (the first one that matches wins)
+CROMA_PRICE_PATTERNS = [
+    re.compile(p, re.IGNORECASE | re.DOTALL)
+    for p in (
+        r'"sellingPrice"\s*:\s*{\s*"value"\s*:\s*"?(?P<v>[\d,]+)"?',
+        r'"pdpPriceData"\s*:\s*{[^}]*"sellingPrice"\s*:\s*{[^}]*"value"\s*:\s*"?(?P<v>[\d,]+)"?',
+        r'"value"\s*:\s*"(?P<v>[\d,]+)"\s*,\s*"currency"',
+        r'"mrp"\s*:\s*{\s*"value"\s*:\s*"(?P<v>[\d,]+)"',
+    )
+]
+NON_PRICE_CHARS = re.compile(r"[^\d.]")
+DIGIT_RE = re.compile(r"\d")
+FILENAME_BAD_CHARS = re.compile(r"[^0-9A-Za-z\-_.]")
+# str.translate table deleting every Latin-1 char that isn't a digit
+NON_DIGITS_TABLE = str.maketrans("", "", "".join(chr(c) for c in range(256) if not chr(c).isdigit()))
+# str.translate table deleting every ASCII char except digits and ".", plus ₹ and nbsp
+PRICE_CHARS_TABLE = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if chr(c) not in "0123456789.") + "₹\xa0"
+)
+
+# <script> tag markers for Croma's embedded JSON state, in order of preference,
+# each with the only price key trusted inside it: the Next.js state carries
+# unrelated `offers` lists, while JSON-LD prices live in offers.price
+CROMA_JSON_MARKERS = (
+    ('id="__NEXT_DATA__"', "sellingPrice"),
+    ('application/ld+json', "offers"),
+)
+
+# Regex fast paths for single-element prices (the Lexbor DOM is the fallback)
+FLIPKART_PRICE_RE = re.compile(r'class="[^"]*\bNx9bqj CxhGGd\b[^"]*"[^>]*>([^<]+)<')
+# opening tag of the Reliance price block, for parse_around()
+RELIANCE_PRICE_TAG_RE = re.compile(r'<div\b[^>]*class="(?:[^"]*\s)?product-price[\s"]')
+AMAZON_PRICE_RE = re.compile(
+    r'class="a-price-whole"[^>]*>\s*([\d,]+)'
+    r'(?:.{0,200}?class="a-price-fraction"[^>]*>\s*(\d+))?',
+    re.DOTALL,
+)
 
 # Supabase client (requires SUPABASE_URL and SUPABASE_KEY)
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Async HTTP client for Slack webhooks, on a small keep-alive pool so
+# consecutive posts reuse one warm TCP+TLS connection.
+slack_client = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+)
+# messages queued during the run, posted in bulk by flush_slack()
+SLACK_QUEUE = []
+# keep each bulk post comfortably under Slack's message size limit
+SLACK_MAX_CHARS = 3500
+
+# Long-lived browser contexts, keyed by (id(browser), site, uses_proxy)
+CONTEXTS = {}
+CONTEXT_PAGES = {}  # same keys -> pages opened in that context
+CONTEXT_USERS = {}  # context -> get_context() callers that haven't released it yet
+RETIRED_CONTEXTS = []
+CONTEXT_LOCK = asyncio.Lock()
+
 
 # ---------------------------
 # Helpers
 # ---------------------------
+async def post_slack(message: str):
+    try:
+        await slack_client.post(SLACK_WEBHOOK, json={"text": message})
+    except Exception as e:
+        print("Slack send error:", e)
+
+
 def send_slack(message: str):
+    """
+    Queue a Slack message. Nothing is sent while pages are being scraped;
+    flush_slack() posts the whole queue at the end of the run.
+    """
     if not SLACK_WEBHOOK:
         print("[SLACK] no webhook configured; skipping Slack post.")
         return
+    SLACK_QUEUE.append(message)
+
+
+async def flush_slack():
+    """
+    Post queued messages joined into as few posts as possible
+    (each at most SLACK_MAX_CHARS, unless a single message is longer).
+    """
+    batches = []
+    for message in SLACK_QUEUE:
+        if batches and len(batches[-1]) + 2 + len(message) <= SLACK_MAX_CHARS:
+            batches[-1] += "\n\n" + message
+        else:
+            batches.append(message)
+    SLACK_QUEUE.clear()
     try:
-        requests.post(SLACK_WEBHOOK, json={"text": message}, timeout=10)
-    except Exception as e:
-        print("Slack send error:", e)
+        for batch in batches:
+            await post_slack(batch)
+    finally:
+        await slack_client.aclose()
 
 
+@functools.lru_cache(maxsize=1)
 def build_apify_proxy_settings():
     """
     Build Playwright proxy dict for Apify proxy or return None if not configured.
     Playwright expects: {"server": "http://host:port", "username": "...", "password": "..."}
     Username encodes groups as: groups-RESIDENTIAL (if APIFY_PROXY_GROUPS set)
+    Cached: it only depends on env vars read at import. Don't mutate the returned dict.
     """
     if not APIFY_PROXY_PASSWORD:
         return None
@@ -72,20 +273,16 @@ def build_apify_proxy_settings():
     return {"server": server, "username": username, "password": APIFY_PROXY_PASSWORD}
 
 
+@functools.lru_cache(maxsize=256)
 def sanitize_filename(s: str) -> str:
-    return re.sub(r"[^0-9A-Za-z-_.]", "_", s)[:240]
+    return FILENAME_BAD_CHARS.sub("_", s)[:240]
 
 
 # ---------------------------
 # Extraction logic
 # ---------------------------
-async def add_stealth_shims(context):
-    """
-    Adds a small stealth script to the context to reduce obvious automation flags.
-    (We add only minimal, safe shims.)
-    """
-    await context.add_init_script(
-        """
+# Minimal, safe shims that hide obvious automation flags (injected once per context)
+STEALTH_JS = """
 try {
   Object.defineProperty(navigator, 'webdriver', { get: () => false, configurable: true });
   Object.defineProperty(navigator, 'languages', { get: () => ['en-US','en'], configurable: true });
@@ -104,13 +301,35 @@ try {
   };
 } catch(e){}
 """
-    )
 
 
-async def create_context_for(browser, site: str):
+async def add_stealth_shims(context):
+    """
+    Adds a small stealth script to the context to reduce obvious automation flags.
+    (We add only minimal, safe shims.)
     """
-    Create a Playwright context configured for the given site.
+    await context.add_init_script(STEALTH_JS)
+
+
+async def block_heavy_resources(route):
+    """
+    Route handler that drops images/media/fonts/stylesheets and third-party trackers;
+    the price only needs the document, first-party scripts and XHR/fetch
+    (Croma fills its window.* objects from those).
+    """
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(d in request.url for d in ANALYTICS_DOMAINS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def create_context_for(browser, site: str, proxy=None):
+    """
+    Create a Playwright context configured for the given site, optionally routed
+    through `proxy` (Playwright proxy dict).
     For Croma, we also add stealth shims and some extra permissions.
+    Heavy resources are blocked for every site.
     """
     real_ua = (
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -124,6 +343,8 @@ async def create_context_for(browser, site: str):
         timezone_id="Asia/Kolkata",
         extra_http_headers={"Accept-Language": "en-US,en;q=0.9"},
     )
+    if proxy:
+        base_opts["proxy"] = proxy
 
     if site == "croma":
         ctx = await browser.new_context(
@@ -137,187 +358,334 @@ async def create_context_for(browser, site: str):
             permissions=["geolocation"],
         )
         await add_stealth_shims(ctx)
+    else:
+        ctx = await browser.new_context(**base_opts)
+
+    await ctx.route("**/*", block_heavy_resources)
+    return ctx
+
+
+async def get_context(browser, site: str, proxy=None):
+    """
+    Return the long-lived context for this browser, site and proxy/no-proxy, creating it
+    (and adding the stealth shims, for croma) on first use, so sites don't share cookie jars.
+    A context is retired after MAX_PAGES_PER_CONTEXT pages so cookies and storage
+    don't pile up across a long run.
+    Every call must be paired with release_context() once its page is closed.
+    """
+    key = (id(browser), site, proxy is not None)
+    async with CONTEXT_LOCK:
+        ctx = CONTEXTS.get(key)
+        if ctx is not None and CONTEXT_PAGES[key] >= MAX_PAGES_PER_CONTEXT:
+            await retire_context(ctx)
+            ctx = None
+        if ctx is None:
+            ctx = await create_context_for(browser, site, proxy)
+            CONTEXTS[key] = ctx
+            CONTEXT_PAGES[key] = 0
+        CONTEXT_PAGES[key] += 1
+        CONTEXT_USERS[ctx] = CONTEXT_USERS.get(ctx, 0) + 1
         return ctx
 
-    return await browser.new_context(**base_opts)
+
+async def release_context(ctx):
+    """
+    Drop one get_context() user of `ctx`; a retired context is closed with its last user.
+    """
+    CONTEXT_USERS[ctx] -= 1
+    if CONTEXT_USERS[ctx] == 0:
+        del CONTEXT_USERS[ctx]
+        if ctx in RETIRED_CONTEXTS:
+            RETIRED_CONTEXTS.remove(ctx)
+            await close_quietly(ctx)
+
+
+async def retire_context(ctx):
+    """
+    Stop handing out `ctx`; the next get_context() call builds a fresh one.
+    The context is closed right away if no task is using it, otherwise by the
+    release_context() of its last user.
+    """
+    for key, cached in list(CONTEXTS.items()):
+        if cached is ctx:
+            del CONTEXTS[key]
+            del CONTEXT_PAGES[key]
+    if CONTEXT_USERS.get(ctx):
+        if ctx not in RETIRED_CONTEXTS:
+            RETIRED_CONTEXTS.append(ctx)
+    else:
+        await close_quietly(ctx)
+
+
+async def close_quietly(ctx):
+    try:
+        await ctx.close()
+    except Exception:
+        pass
+
+
+async def close_contexts():
+    for ctx in list(CONTEXTS.values()) + RETIRED_CONTEXTS:
+        await close_quietly(ctx)
+    CONTEXTS.clear()
+    CONTEXT_PAGES.clear()
+    CONTEXT_USERS.clear()
+    RETIRED_CONTEXTS.clear()
+
+
+def rupees_to_paise(value) -> int:
+    """
+    Exact rupees -> integer paise (e.g. "44999.50" -> 4499950), no float rounding.
+    """
+    return int((Decimal(str(value)) * 100).to_integral_value(ROUND_HALF_UP))
 
 
 def normalize_price_string(price_raw: str):
+    """
+    Return the price in integer paise, or None if no number can be read.
+    """
     if not price_raw:
         return None
-    s = str(price_raw)
-    s = s.replace("₹", "").replace("INR", "").replace("MRP", "")
-    s = re.sub(r"[^\d.,]", "", s)
-    if s.count(",") and s.count(".") == 0:
-        s = s.replace(",", "")
-    s = s.replace(",", "")
-    return s.strip() if s else None
+    # one C-level pass drops currency marks, words like INR/MRP, spaces and commas
+    s = str(price_raw).translate(PRICE_CHARS_TABLE)
+    if not s.isascii():
+        # rare non-ASCII leftovers (other currency signs, dashes...)
+        s = NON_PRICE_CHARS.sub("", s)
+    if not s:
+        return None
+    try:
+        return rupees_to_paise(s)
+    except InvalidOperation:
+        return None
 
 
-async def extract_price(site: str, html: str, page=None):
+def parse_around(html: str, tag_rx, window: int = 4096):
     """
-    Return raw price string (may contain digits/comma/dot) or None.
-    For croma we attempt page.evaluate checks first (if page provided), else HTML parse.
+    Parse only the slice of `html` starting at the price element's opening tag
+    (first match of `tag_rx`), instead of the whole multi-MB document.
+    Falls back to parsing everything when the tag isn't found.
     """
-    soup = BeautifulSoup(html, "html.parser")
+    m = tag_rx.search(html)
+    if not m:
+        return LexborHTMLParser(html)
+    return LexborHTMLParser(html[m.start():m.start() + window])
+
+
+def iter_json_scripts(html: str, marker: str):
+    """
+    Yield the parsed body of every <script> whose opening tag contains `marker`
+    (e.g. id="__NEXT_DATA__"), found with plain str.find; bodies that aren't valid JSON are skipped.
+    """
+    i = html.find(marker)
+    while i != -1:
+        start = html.find(">", i) + 1
+        end = html.find("</script>", start)
+        if not start or end == -1:
+            return
+        try:
+            yield json.loads(html[start:end])
+        except ValueError:
+            pass
+        i = html.find(marker, end)
+
+
+def find_price_in_json(data, key: str):
+    """
+    Depth-first search of parsed JSON for sellingPrice.value (key="sellingPrice",
+    Croma state) or offers.price (key="offers", schema.org JSON-LD).
+    Returns the raw value or None; empty and zero (placeholder) values are skipped.
+    """
+    if isinstance(data, dict):
+        if key == "sellingPrice":
+            sp = data.get("sellingPrice")
+            if isinstance(sp, dict) and normalize_price_string(sp.get("value")):
+                return sp["value"]
+        else:
+            offers = data.get("offers")
+            for offer in offers if isinstance(offers, list) else [offers]:
+                if isinstance(offer, dict) and normalize_price_string(offer.get("price")):
+                    return offer["price"]
+        children = data.values()
+    elif isinstance(data, list):
+        children = data
+    else:
+        return None
+    for child in children:
+        found = find_price_in_json(child, key)
+        if found is not None:
+            return found
+    return None
+
+
+def extract_flipkart(html: str):
     price_raw = None
+    m = FLIPKART_PRICE_RE.search(html)
+    if m:
+        price_raw = unescape(m.group(1))
+    # React can split the text (e.g. "₹<!-- -->1,299"), leaving the regex just "₹"
+    if not price_raw or not DIGIT_RE.search(price_raw):
+        tree = LexborHTMLParser(html)
+        el = tree.css_first(".Nx9bqj.CxhGGd")
+        price_raw = el.text() if el else None
+    return price_raw
 
-    if site == "flipkart":
-        el = soup.select_one(".Nx9bqj.CxhGGd")
-        price_raw = el.text if el else None
 
-    elif site == "amazon":
-        whole = soup.select_one("span.a-price-whole")
-        frac = soup.select_one("span.a-price-fraction")
+def extract_amazon(html: str):
+    price_raw = None
+    m = AMAZON_PRICE_RE.search(html)
+    if m and DIGIT_RE.search(m.group(1)):
+        price_raw = f"{m.group(1).replace(',', '')}.{m.group(2) or '00'}"
+    else:
+        tree = LexborHTMLParser(html)
+        whole = tree.css_first("span.a-price-whole")
+        frac = tree.css_first("span.a-price-fraction")
         if whole:
-            whole_digits = "".join(filter(str.isdigit, whole.text))
-            frac_digits = "".join(filter(str.isdigit, frac.text)) if frac else "00"
+            whole_digits = whole.text().translate(NON_DIGITS_TABLE)
+            frac_digits = frac.text().translate(NON_DIGITS_TABLE) if frac else "00"
             price_raw = f"{whole_digits}.{frac_digits}"
+    return price_raw
 
-    elif site == "reliance":
-        el = soup.select_one("div.product-price")
-        if el:
-            price_raw = el.get_text(strip=True).replace("MRP", "")
 
-    elif site == "croma":
-        # Prefer reading from page JS objects if possible
-        if page:
-            try:
-                found = await page.evaluate(
-                    """() => {
-                        function inspect(o) {
-                          try {
-                            if (!o || typeof o !== 'object') return null;
-                            if (Object.prototype.hasOwnProperty.call(o, 'sellingPrice')) {
-                              let sp = o['sellingPrice'];
-                              if (sp && (sp.value || sp.value === 0)) return sp.value;
-                            }
-                            if (Object.prototype.hasOwnProperty.call(o, 'pdpPriceData')) {
-                              let pd = o['pdpPriceData'];
-                              if (pd && pd.sellingPrice && (pd.sellingPrice.value || pd.sellingPrice.value === 0)) return pd.sellingPrice.value;
-                            }
-                            if (o && o.price && o.price.sellingPrice && o.price.sellingPrice.value) return o.price.sellingPrice.value;
-                          } catch(e){}
-                          return null;
-                        }
-                        try {
-                          const keys = Object.keys(window);
-                          for (let i=0;i<keys.length;i++){
-                            try {
-                              const v = window[keys[i]];
-                              if (!v || typeof v !== 'object') continue;
-                              let r = inspect(v);
-                              if (r) return String(r);
-                              const subkeys = Object.keys(v || {});
-                              for (let j=0;j<subkeys.length;j++){
-                                try {
-                                  const vv = v[subkeys[j]];
-                                  if (vv && typeof vv === 'object') {
-                                    let r2 = inspect(vv);
-                                    if (r2) return String(r2);
-                                  }
-                                } catch(e2){}
-                              }
-                            } catch(e1){}
-                          }
-                        } catch(e){}
-                        return null;
-                    }"""
-                )
-                if found:
-                    price_raw = str(found)
-            except Exception:
-                price_raw = price_raw
-
-        # fallback: regex/script/DOM in HTML
-        if not price_raw:
-            regexes = [
-                r'"sellingPrice"\s*:\s*{\s*"value"\s*:\s*"?(?P<v>[\d,]+)"?',
-                r'"pdpPriceData"\s*:\s*{[^}]*"sellingPrice"\s*:\s*{[^}]*"value"\s*:\s*"?(?P<v>[\d,]+)"?',
-                r'"value"\s*:\s*"(?P<v>[\d,]+)"\s*,\s*"currency"',
-                r'"mrp"\s*:\s*{\s*"value"\s*:\s*"(?P<v>[\d,]+)"',
-            ]
-            for rx in regexes:
-                m = re.search(rx, html, re.IGNORECASE | re.DOTALL)
-                if m:
-                    price_raw = m.group("v")
-                    break
+def extract_reliance(html: str):
+    price_raw = None
+    tree = parse_around(html, RELIANCE_PRICE_TAG_RE)
+    el = tree.css_first("div.product-price")
+    if el:
+        price_raw = el.text(strip=True).replace("MRP", "")
+    return price_raw
 
-            if not price_raw:
-                for s in soup.find_all("script"):
-                    text = s.string or s.get_text() or ""
-                    if not text:
-                        continue
-                    for rx in regexes:
-                        m = re.search(rx, text, re.IGNORECASE | re.DOTALL)
-                        if m:
-                            price_raw = m.group("v")
-                            break
-                    if price_raw:
-                        break
-
-        if not price_raw:
-            el = (
-                soup.select_one("#pdp-product-price")
-                or soup.select_one("div.product-price")
-                or soup.select_one("span.pdp-selling-price")
-                or soup.select_one("span.price")
-                or soup.select_one("span.offer-price")
-            )
-            if el:
-                price_raw = el.get("value") or el.get_text(strip=True)
 
+def extract_croma(html: str):
+    """
+    Reads the embedded JSON blobs, then a regex over the raw HTML, then DOM selectors.
+    (The live-page probe, CROMA_EXTRACT_JS, runs before the HTML is even fetched.)
+    """
+    price_raw = None
+
+    # embedded JSON state, located with str.find and read with json.loads
+    for marker, key in CROMA_JSON_MARKERS:
+        for data in iter_json_scripts(html, marker):
+            found = find_price_in_json(data, key)
+            if found is not None:
+                price_raw = str(found)
+                break
+        if price_raw:
+            break
+
+    # fallback: regex over the raw HTML (this covers inline <script> contents too)
+    if not price_raw:
+        for rx in CROMA_PRICE_PATTERNS:
+            m = rx.search(html)
+            if m:
+                price_raw = m.group("v")
+                break
+
+    # last resort: DOM selectors; only now is the HTML parsed
+    if not price_raw:
+        tree = LexborHTMLParser(html)
+        el = (
+            tree.css_first("#pdp-product-price")
+            or tree.css_first("div.product-price")
+            or tree.css_first("span.pdp-selling-price")
+            or tree.css_first("span.price")
+            or tree.css_first("span.offer-price")
+        )
+        if el:
+            price_raw = el.attributes.get("value") or el.text(strip=True)
     return price_raw
 
 
+# site -> extractor(html) returning the raw price string or None (plain sync code)
+EXTRACTORS = {
+    "flipkart": extract_flipkart,
+    "amazon": extract_amazon,
+    "reliance": extract_reliance,
+    "croma": extract_croma,
+}
+
+
+async def extract_price(site: str, html: str):
+    """
+    Return raw price string (may contain digits/comma/dot) or None.
+    Flipkart/Amazon try a regex over the raw HTML first; a Lexbor DOM is only
+    built when that misses (or for the Reliance / Croma DOM lookups).
+    """
+    extractor = EXTRACTORS.get(site)
+    if not extractor:
+        return None
+    # regex / JSON / DOM work is CPU-bound: run it in a worker thread so the
+    # event loop keeps driving the other pages meanwhile
+    return await asyncio.to_thread(extractor, html)
+
+
 # ---------------------------
 # Page price extraction flow
 # ---------------------------
-async def get_price_with_context(browser, site: str, url: str):
+async def get_price_with_context(browser, site: str, url: str, proxy=None):
     attempt = 0
     last_exc = None
     while attempt < 2:
         attempt += 1
-        context = await create_context_for(browser, site)
-        page = await context.new_page()
+        context = await get_context(browser, site, proxy)
         try:
-            # tiny human-like delay
-            await asyncio.sleep(random.uniform(0.2, 0.6))
+            page = await context.new_page()
+        except Exception:
+            await release_context(context)
+            raise
+        try:
+            if site == "croma":
+                # tiny human-like delay; only Croma's bot checks look at this
+                await asyncio.sleep(random.uniform(0.2, 0.6))
+                try:
+                    await page.mouse.move(random.randint(10, 60), random.randint(10, 60), steps=3)
+                except Exception:
+                    pass
+                await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+            else:
+                await page.goto(url, timeout=60000, wait_until="domcontentloaded")
+
+            # wait until the price is actually on the page, then read the DOM once;
+            # a timeout just means we extract from whatever has loaded
             try:
-                await page.mouse.move(random.randint(10, 60), random.randint(10, 60), steps=3)
+                if site == "croma":
+                    await page.wait_for_function(CROMA_READY_JS, timeout=15000, polling=200)
+                elif site in SITE_PRICE_SELECTOR:
+                    await page.wait_for_selector(SITE_PRICE_SELECTOR[site], state="visible", timeout=5000)
             except Exception:
                 pass
 
+            # read the price element in the browser first; the full HTML only
+            # crosses the CDP pipe when that comes back empty
+            price_raw = None
             if site == "croma":
-                await page.goto(url, timeout=90000, wait_until="networkidle")
-                await page.wait_for_timeout(1200)
-            else:
-                await page.goto(url, timeout=60000, wait_until="domcontentloaded")
-
-            # specific wait for reliance price
-            if site == "reliance":
                 try:
-                    await page.wait_for_selector("div.product-price", timeout=15000)
-                except Exception:
-                    pass
-
-            html = await page.content()
-            price_raw = await extract_price(site, html, page=page)
+                    data = await page.evaluate(CROMA_EXTRACT_JS)
+                except PlaywrightError:
+                    data = None
+                if data:
+                    price_raw = data.get("price")
+            else:
+                eval_js = PRICE_EVAL_JS.get(site)
+                if eval_js:
+                    try:
+                        price_raw = await page.evaluate(eval_js)
+                    except PlaywrightError:
+                        price_raw = None
 
             if not price_raw:
-                # wait a tiny bit and retry the DOM
-                await page.wait_for_timeout(1000)
-                html2 = await page.content()
-                price_raw = await extract_price(site, html2, page=page)
+                html = await page.content()
+                price_raw = await extract_price(site, html)
 
             if not price_raw:
-                # save HTML only on failure for debugging
+                # save HTML only on failure for debugging (DEBUG_DUMPS=1)
                 try:
-                    parsed = url.replace("://", "_").replace("/", "_")
-                    fname = sanitize_filename(f"{site}_{parsed}") + ".html"
-                    file_path = DEBUG_DIR / fname
-                    file_path.write_text(html, encoding="utf-8")
-                    print(f"[DEBUG] saved failing HTML to {file_path}")
+                    if DEBUG_DUMPS:
+                        parsed = url.replace("://", "_").replace("/", "_")
+                        fname = sanitize_filename(f"{site}_{parsed}") + ".html"
+                        file_path = DEBUG_DIR / fname
+                        # off the event loop, so other pages keep going
+                        await asyncio.to_thread(file_path.write_text, html, encoding="utf-8")
+                        print(f"[DEBUG] saved failing HTML to {file_path}")
                     snippet = (html[:800] + "...") if len(html) > 800 else html
                     print("[DEBUG] HTML snippet:", snippet)
                 except Exception as dump_e:
@@ -325,13 +693,15 @@ async def get_price_with_context(browser, site: str, url: str):
 
                 raise Exception("Price not found (no matching pattern / selector).")
 
-            price_str = normalize_price_string(price_raw)
-            if not price_str:
+            paise = normalize_price_string(price_raw)
+            if paise is None:
                 raise Exception("Price normalization failed.")
+            if paise == 0:
+                # a zero is a placeholder, never a real price (and would fire a drop alert)
+                raise Exception("Price read as 0 (placeholder).")
 
             await page.close()
-            await context.close()
-            return float(price_str)
+            return paise
 
         except PlaywrightError as e:
             msg = str(e)
@@ -341,10 +711,8 @@ async def get_price_with_context(browser, site: str, url: str):
                     await page.close()
                 except Exception:
                     pass
-                try:
-                    await context.close()
-                except Exception:
-                    pass
+                # don't reuse a context whose connection just failed
+                await retire_context(context)
                 raise e  # propagate proxy/network errors up
             last_exc = e
             print(f"[WARN] attempt {attempt} failed for {url}: {e}")
@@ -352,10 +720,6 @@ async def get_price_with_context(browser, site: str, url: str):
                 await page.close()
             except Exception:
                 pass
-            try:
-                await context.close()
-            except Exception:
-                pass
             await asyncio.sleep(0.7 * attempt)
             continue
 
@@ -366,23 +730,207 @@ async def get_price_with_context(browser, site: str, url: str):
                 await page.close()
             except Exception:
                 pass
-            try:
-                await context.close()
-            except Exception:
-                pass
             await asyncio.sleep(0.7 * attempt)
             continue
 
+        finally:
+            # the page is closed on every path above; a retired context goes with it
+            await release_context(context)
+
     print(f"[ERROR] get_price_with_context failed for {url}: {last_exc}")
     return None
 
 
+# ---------------------------
+# Browser pool
+# ---------------------------
+class BrowserPool:
+    """
+    A few Chromium instances shared by concurrent scrapes, so parallel pages are
+    spread over several browser processes instead of one.
+    The slot queue holds `slots` entries handed out round-robin over the browsers;
+    it also caps how many pages are open at once.
+    """
+
+    def __init__(self, launch, size: int, slots: int):
+        self.launch = launch
+        self.slots = max(1, slots)
+        # no point launching browsers that no slot would ever hand out
+        self.size = min(size, self.slots)
+        self.browsers = []
+        self.queue = asyncio.Queue()
+
+    async def start(self):
+        results = await asyncio.gather(*(self.launch() for _ in range(self.size)), return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                print("[WARN] could not launch pooled browser:", r)
+            else:
+                self.browsers.append(r)
+        if not self.browsers:
+            raise results[0]
+        for i in range(self.slots):
+            self.queue.put_nowait(self.browsers[i % len(self.browsers)])
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        browser = await self.queue.get()
+        try:
+            yield browser
+        finally:
+            self.queue.put_nowait(browser)
+
+    async def get_price(self, site: str, url: str, proxy=None):
+        async with self.acquire() as browser:
+            return await get_price_with_context(browser, site, url, proxy)
+
+    async def close(self):
+        for browser in self.browsers:
+            try:
+                await browser.close()
+            except Exception:
+                pass
+        self.browsers = []
+
+
+# ---------------------------
+# Per-item flow
+# ---------------------------
+async def fetch_price(site: str, url: str, pool):
+    print(f"Checking {site.upper() if site else site} → {url}")
+
+    # If site is croma, try a proxied context first if the proxy is configured
+    apify_proxy = build_apify_proxy_settings()
+    if site == "croma" and apify_proxy:
+        try:
+            return await pool.get_price(site, url, apify_proxy)
+        except PlaywrightError as pe:
+            # Proxy-level error; retry once with a no-proxy context
+            print("[WARN] proxy connection error for Croma. Retrying without proxy:", pe)
+            return await pool.get_price(site, url)
+    return await pool.get_price(site, url)
+
+
+def build_rows(item, site, url, paise):
+    """
+    Build the price_history / tracked_items rows for one tracked item from an
+    already scraped price, and send its drop alert if the target is reached.
+    """
+    target_price = item.get("target_price") or 0
+
+    # compare in integer paise; Supabase keeps storing rupees
+    price = paise / 100
+
+    # the columns this job owns plus TRACKED_REQUIRED_COLUMNS: edits made during
+    # the run to target_price, active etc. survive the batched upsert, but an
+    # edited site/product_url is reverted and a deleted row is re-inserted
+    history_row = {"tracked_item_id": item["id"], "price": price}
+    tracked_row = {
+        "id": item["id"],
+        # NOT NULL columns the upsert's insert arm needs, as read at the start
+        **{col: item.get(col) for col in TRACKED_REQUIRED_COLUMNS},
+        "last_price": price,
+        "last_checked_at": datetime.now(timezone.utc).isoformat(),
+        "notified": bool(item.get("notified")),
+    }
+
+    if paise >= rupees_to_paise(target_price):
+        print(f"Price OK: {price}, not below target {target_price}")
+        return history_row, tracked_row
+
+    if not item.get("notified"):
+        msg = (
+            f"💰 PRICE DROP ALERT!\n"
+            f"Site: *{site}*\n"
+            f"URL: {url}\n"
+            f"Current Price: ₹{price}\n"
+            f"Target Price: ₹{target_price}"
+        )
+        send_slack(msg)
+        tracked_row["notified"] = True
+
+    return history_row, tracked_row
+
+
+async def process_url(site, url, items, pool):
+    """
+    Scrape one product URL once and fan the price out to every item tracking it.
+    Runs concurrently with other URLs; the pool's slots bound the number of open pages.
+    Returns a list of (price_history row, tracked_items row or None) for save_results(),
+    empty if the URL errored out.
+    """
+    try:
+        paise = await fetch_price(site, url, pool)
+
+        if paise is None:
+            msg = f"❗ ERROR: Could not extract price.\nSite: {site}\nURL: {url}"
+            print(msg)
+            send_slack(msg)
+            return [({"tracked_item_id": item["id"], "price": None}, None) for item in items]
+
+        return [build_rows(item, site, url, paise) for item in items]
+
+    except Exception as e:
+        error_msg = f"❗ CRITICAL ERROR scraping URL:\n{url}\nError: {e}"
+        print(error_msg)
+        send_slack(error_msg)
+        traceback.print_exc()
+        return []
+
+
+def save_results(results):
+    """
+    Write all per-URL results in two round-trips:
+    one bulk insert into price_history and one bulk upsert into tracked_items.
+    The upsert writes site/product_url back as read and re-inserts rows deleted
+    during the run (see TRACKED_REQUIRED_COLUMNS); per-row updates would avoid
+    that at the cost of one round-trip per item.
+    """
+    history_rows = []
+    tracked_rows = []
+    for result in results:
+        if not result or isinstance(result, BaseException):
+            continue
+        for history_row, tracked_row in result:
+            history_rows.append(history_row)
+            if tracked_row:
+                tracked_rows.append(tracked_row)
+
+    # separate round-trips, so a bad history row doesn't also lose notified=True
+    # (which would repeat the same drop alerts on the next run)
+    if history_rows:
+        try:
+            supabase.table("price_history").insert(history_rows).execute()
+        except Exception as e:
+            error_msg = f"❗ CRITICAL ERROR inserting {len(history_rows)} rows into price_history:\nError: {e}"
+            print(error_msg)
+            send_slack(error_msg)
+            traceback.print_exc()
+    if tracked_rows:
+        try:
+            supabase.table("tracked_items").upsert(tracked_rows, on_conflict="id").execute()
+        except Exception as e:
+            error_msg = f"❗ CRITICAL ERROR upserting {len(tracked_rows)} rows into tracked_items:\nError: {e}"
+            print(error_msg)
+            send_slack(error_msg)
+            traceback.print_exc()
+
+
 # ---------------------------
 # Main run flow
 # ---------------------------
 async def run_price_check():
     print("Fetching items from Supabase...")
-    resp = supabase.table("tracked_items").select("*").eq("active", True).execute()
+    # skip rows checked recently (e.g. by an overlapping manual run) on the server side
+    cutoff = (datetime.now(timezone.utc) - timedelta(minutes=RECHECK_AFTER_MINUTES)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    resp = (
+        supabase.table("tracked_items")
+        # only the columns the check reads; the upsert sends back just its own
+        .select("id,site,product_url,target_price,notified")
+        .eq("active", True)
+        .or_(f"last_checked_at.is.null,last_checked_at.lt.{cutoff}")
+        .execute()
+    )
     if hasattr(resp, "data"):
         items = resp.data
     elif isinstance(resp, dict) and "data" in resp:
@@ -391,9 +939,16 @@ async def run_price_check():
         items = resp
 
     if not items:
-        print("No active items found.")
+        print(f"No active items due for a check (items checked in the last {RECHECK_AFTER_MINUTES} min are skipped).")
         return
 
+    # a URL tracked by several users is scraped once and its price fanned out
+    by_url = {}
+    for item in items:
+        key = ((item.get("site") or "").lower(), item.get("product_url"))
+        by_url.setdefault(key, []).append(item)
+    print(f"{len(items)} items across {len(by_url)} unique URLs")
+
     launch_args = [
         "--no-sandbox",
         "--disable-blink-features=AutomationControlled",
@@ -401,108 +956,37 @@ async def run_price_check():
         "--disable-infobars",
     ]
 
-    # apify proxy config (only used for Croma)
-    apify_proxy = build_apify_proxy_settings()
-
     async with async_playwright() as p:
-        # helper to start browsers: proxy_browser (if apify_proxy set) and default_browser
-        async def _launch_browser(use_proxy: bool):
-            kwargs = {"headless": True, "args": launch_args}
-            if use_proxy and apify_proxy:
-                kwargs["proxy"] = apify_proxy
-            return await p.chromium.launch(**kwargs)
-
-        # default browser (no proxy) used for non-Croma and fallback
+        # browsers are launched without a proxy; the Apify proxy (Croma only)
+        # is applied per context, so the same browsers serve every site
+        async def _launch_browser():
+            return await p.chromium.launch(headless=True, args=launch_args)
+
+        pool = BrowserPool(_launch_browser, BROWSER_POOL_SIZE, MAX_PARALLEL_PAGES)
         try:
-            browser_default = await _launch_browser(False)
+            await pool.start()
         except Exception as e:
-            print("[ERROR] could not launch default browser:", e)
+            print("[ERROR] could not launch browser:", e)
             return
 
-        browser_proxy = None
-        if apify_proxy:
-            try:
-                browser_proxy = await _launch_browser(True)
-            except Exception as e:
-                print("[WARN] could not launch proxy browser; continuing with default only:", e)
-                browser_proxy = None
-
         try:
-            for item in items:
-                site = (item.get("site") or "").lower()
-                url = item.get("product_url")
-                target_price = item.get("target_price") or 0
+            results = await asyncio.gather(
+                *(process_url(site, url, group, pool) for (site, url), group in by_url.items()),
+                return_exceptions=True,
+            )
+            save_results(results)
+        finally:
+            await close_contexts()
+            await pool.close()
 
-                print(f"Checking {site.upper() if site else site} → {url}")
 
-                try:
-                    price = None
-                    # If site is croma, try proxy browser first if available
-                    if site == "croma" and browser_proxy:
-                        try:
-                            price = await get_price_with_context(browser_proxy, site, url)
-                        except PlaywrightError as pe:
-                            # Proxy-level error; retry once with default no-proxy browser
-                            print("[WARN] proxy connection error for Croma. Retrying without proxy:", pe)
-                            price = await get_price_with_context(browser_default, site, url)
-                    else:
-                        price = await get_price_with_context(browser_default, site, url)
-
-                    if price is None:
-                        msg = f"❗ ERROR: Could not extract price.\nSite: {site}\nURL: {url}"
-                        print(msg)
-                        send_slack(msg)
-                        supabase.table("price_history").insert({
-                            "tracked_item_id": item["id"],
-                            "price": None,
-                        }).execute()
-                        continue
-
-                    # update tracked_items and history
-                    supabase.table("tracked_items").update({
-                        "last_price": price,
-                        "last_checked_at": datetime.now(timezone.utc).isoformat()
-                    }).eq("id", item["id"]).execute()
-
-                    supabase.table("price_history").insert({
-                        "tracked_item_id": item["id"],
-                        "price": price,
-                    }).execute()
-
-                    if price >= (target_price or 0):
-                        print(f"Price OK: {price}, not below target {target_price}")
-                        continue
-
-                    if not item.get("notified"):
-                        msg = (
-                            f"💰 PRICE DROP ALERT!\n"
-                            f"Site: *{site}*\n"
-                            f"URL: {url}\n"
-                            f"Current Price: ₹{price}\n"
-                            f"Target Price: ₹{target_price}"
-                        )
-                        send_slack(msg)
-                        supabase.table("tracked_items").update({
-                            "notified": True
-                        }).eq("id", item["id"]).execute()
-
-                except Exception as e:
-                    error_msg = f"❗ CRITICAL ERROR scraping URL:\n{url}\nError: {e}"
-                    print(error_msg)
-                    send_slack(error_msg)
-                    traceback.print_exc()
-        finally:
-            try:
-                if browser_proxy:
-                    await browser_proxy.close()
-            except Exception:
-                pass
-            try:
-                if browser_default:
-                    await browser_default.close()
-            except Exception:
-                pass
+async def main():
+    # flush/close the shared Slack client on every exit path of the run
+    try:
+        await run_price_check()
+    finally:
+        await flush_slack()
 
 
 if __name__ == "__main__":
-    asyncio.run(run_price_check())
+    asyncio.run(main())